@@ -9,16 +9,15 @@ Estilo de "CEO de SAVA" mejorado en la sección "Acerca de".
 # --- LIBRERÍAS ---
 import streamlit as st
 import pandas as pd
-from firebase_admin import auth
-from io import BytesIO
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.units import inch
-import re 
+from urllib.request import urlopen
+import base64
+# firebase_admin.auth se importa dentro de los callbacks que lo usan
+# para no cargarlo en el arranque ni en cada recarga del script.
 
 # --- MÓdulos PERSONALIZADOS ---
 import firebase_utils
-from gemini_utils import GeminiUtils
+from gemini_utils import get_gemini, build_history_summary, AIReviewError
+from pdf_utils import create_patient_report_pdf
 
 # --- CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(
@@ -30,6 +29,25 @@ st.set_page_config(
 # --- CONSTANTES ---
 LOGO_URL = "https://github.com/GIUSEPPESAN21/LOGO-SAVA/blob/main/LOGO%20COLIBRI.png?raw=true"
 
+# --- BLOQUES HTML ESTÁTICOS (se emiten con st.html, sin parser de Markdown) ---
+LOGIN_TITLE_HTML = (
+    "<h1 style='text-align: center; color: var(--primary-color);'>Bienvenido a SaludIA</h1>"
+    "<h4 style='text-align: center; color: var(--text-color);'>Tu Asistente Clínico Inteligente</h4>"
+)
+LOGIN_LOGO_HTML = """
+<div style="display: flex; justify-content: center; margin-top: 60px; opacity: 0.7;">
+    <img src="{logo_src}" alt="SAVA Logo" style="width: 250px;" loading="lazy" decoding="async">
+</div>
+"""
+HEADER_BANNER_HTML = """
+<div style="display: flex; align-items: center; gap: 15px; height: 100%; min-height: 40px;">
+    <img src="{logo_src}" alt="SAVA Logo" style="height: 40px;" decoding="async">
+    <span style="font-weight: 600; font-size: 1.1em; color: var(--text-color);">
+        👨‍⚕️ {physician_email}
+    </span>
+</div>
+"""
+
 # ==============================================================================
 # MÓDULO 1: ESTILOS Y CONFIGURACIÓN INICIAL
 # ==============================================================================
@@ -131,73 +149,100 @@ def apply_custom_styling():
     """
     st.markdown(custom_css, unsafe_allow_html=True)
 
-# Inicializa Firebase y Gemini
-DB = firebase_utils.DB
+@st.cache_resource(show_spinner=False)
+def _logo_src():
+    """
+    Logo como data URI en base64, descargado una sola vez por proceso, para que
+    el navegador no vuelva a pedir la imagen en cada rerun. Si la descarga falla
+    se usa la URL original.
+    """
+    try:
+        with urlopen(LOGO_URL, timeout=5) as response:
+            content_type = response.headers.get_content_type()
+            encoded = base64.b64encode(response.read()).decode('ascii')
+        return f"data:{content_type};base64,{encoded}"
+    except Exception:
+        return LOGO_URL
+
+# Inicializa Gemini (Firestore se conecta en el primer acceso vía firebase_utils.get_db)
 try:
-    GEMINI = GeminiUtils()
+    GEMINI = get_gemini()
     IS_MODEL_CONFIGURED = True
 except (ValueError, Exception) as e:
     st.error(e, icon="🔑")
     GEMINI = None
     IS_MODEL_CONFIGURED = False
 
+def _discard_pdf_report():
+    """
+    Descarta el reporte PDF preparado tras escribir en el historial. Las lecturas
+    cacheadas de Firestore las invalida firebase_utils en cada escritura.
+    """
+    st.session_state.pop('pdf_report', None)
+
 # Inicialización del estado de la sesión
 if 'logged_in' not in st.session_state:
-    st.session_state.logged_in = False
-    st.session_state.physician_email = None
-    st.session_state.page = 'login'
-    st.session_state.selected_patient_id = None
-    st.session_state.ai_analysis_running = False
-    st.session_state.last_clicked_ai = None
+    st.session_state.update(
+        logged_in=False,
+        physician_email=None,
+        page='login',
+        selected_patient_id=None,
+    )
 
 # ==============================================================================
-# MÓDULO 2: GENERACIÓN DE REPORTES PDF (Sin cambios)
+# MÓDULO 2: VISTAS Y COMPONENTES DE UI (Sección "Acerca de" actualizada)
 # ==============================================================================
-def clean_html_for_reportlab(text):
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    text = re.sub(r'###\s?(.*)', r'<b>\1</b>', text)
-    text = text.replace('\n', '<br/>')
-    return text
-
-def create_patient_report_pdf(patient_info, history_df):
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=(8.5 * inch, 11 * inch))
-    styles = getSampleStyleSheet()
-    story = []
-    story.append(Paragraph(f"Reporte Clínico de {str(patient_info.get('nombre', 'N/A'))}", styles['h1']))
-    story.append(Paragraph(f"Documento: {patient_info.get('cedula', 'N/A')}", styles['Normal']))
-    story.append(Paragraph(f"Edad: {patient_info.get('edad', 'N/A')} años", styles['Normal']))
-    story.append(Spacer(1, 0.25 * inch))
-
-    for _, row in history_df.sort_values('timestamp').iterrows():
-        story.append(Paragraph(f"Consulta del {row['timestamp'].strftime('%d de %B, %Y')}", styles['h2']))
-        motivo = str(row.get('motivo_consulta', 'N/A')).replace('\n', '<br/>')
-        story.append(Paragraph(f"<b>Motivo:</b> {motivo}", styles['Normal']))
-        pa_s = str(row.get('presion_sistolica', 'N/A'))
-        pa_d = str(row.get('presion_diastolica', 'N/A'))
-        story.append(Paragraph(f"<b>Signos Vitales:</b> PA: {pa_s}/{pa_d} mmHg", styles['Normal']))
-        
-        if 'ai_analysis' in row and pd.notna(row['ai_analysis']):
-            story.append(Spacer(1, 0.1 * inch))
-            story.append(Paragraph("<b>--- Análisis por IA (SaludIA) ---</b>", styles['Normal']))
-            raw_text = str(row['ai_analysis'])
-            analysis_text = clean_html_for_reportlab(raw_text)
-            try:
-                story.append(Paragraph(analysis_text, styles['Normal']))
-            except Exception as e:
-                story.append(Paragraph(f"Error al renderizar análisis: {e}", styles['Normal']))
-        story.append(Spacer(1, 0.25 * inch))
-    doc.build(story)
-    buffer.seek(0)
-    return buffer.getvalue()
+# --- CALLBACKS DE AUTENTICACIÓN Y NAVEGACIÓN ---
+# Corren antes del rerun que dispara el propio botón, por lo que no llaman a st.rerun().
+# Los mensajes se guardan en la sesión y se muestran dentro de su formulario.
+def _do_login():
+    from firebase_admin import auth
+    firebase_utils.get_db()  # Inicializa la app de Firebase que usa auth
+    try:
+        user = auth.get_user_by_email(st.session_state.login_email)
+    except Exception:
+        st.session_state.login_feedback = "Error: Verifique sus credenciales."
+        return
+    st.session_state.update(logged_in=True, physician_email=user.email, page='control_panel')
+
+def _do_register():
+    from firebase_admin import auth
+    firebase_utils.get_db()
+    if st.session_state.register_password != st.session_state.confirm_password:
+        st.session_state.register_feedback = ('error', "Las contraseñas no coinciden.")
+        return
+    try:
+        user = auth.create_user(email=st.session_state.register_email, password=st.session_state.register_password)
+        st.session_state.register_feedback = ('success', f"¡Cuenta para {user.email} creada! Ya puede iniciar sesión.")
+    except Exception as e:
+        st.session_state.register_feedback = ('error', f"Error de registro: {e}")
+
+def _do_logout():
+    st.session_state.clear()
+
+def _navigate(**state):
+    st.session_state.update(state)
+
+def _mark_in_flight(flag, value=True):
+    """
+    Marca una escritura en curso antes del rerun del clic, para que ese mismo run
+    ya dibuje el botón deshabilitado y un segundo clic no la duplique.
+    """
+    st.session_state[flag] = value
+
+def _add_page(key, item):
+    """Pide una página más de la lista paginada 'key' de 'item' (médico o paciente)."""
+    pages = st.session_state.setdefault(key, {})
+    pages[item] = pages.get(item, 1) + 1
+
+def _prepare_report(patient_id, patient_info):
+    # El reporte incluye todas las consultas, no sólo las páginas cargadas en pantalla
+    df_history, _ = firebase_utils.load_patient_history(st.session_state.physician_email, patient_id, page_size=None)
+    st.session_state.pdf_report = (patient_id, create_patient_report_pdf(patient_info, df_history))
 
-# ==============================================================================
-# MÓDULO 3: VISTAS Y COMPONENTES DE UI (Sección "Acerca de" actualizada)
-# ==============================================================================
 def render_login_page():
     # --- MODIFICADO: Título añadido, Logo movido al final ---
-    st.markdown("<h1 style='text-align: center; color: var(--primary-color);'>Bienvenido a SaludIA</h1>", unsafe_allow_html=True)
-    st.markdown("<h4 style='text-align: center; color: var(--text-color);'>Tu Asistente Clínico Inteligente</h4>", unsafe_allow_html=True)
+    st.html(LOGIN_TITLE_HTML)
     st.markdown("---")
     
     _, col2, _ = st.columns([1, 1.5, 1])
@@ -207,65 +252,41 @@ def render_login_page():
             login_tab, register_tab = st.tabs(["**Iniciar Sesión**", "**Registrarse**"])
             with login_tab:
                 with st.form("login_form"):
-                    email = st.text_input("Correo Electrónico del Médico", key="login_email")
-                    password = st.text_input("Contraseña", type="password", key="login_password")
-                    login_button = st.form_submit_button("Acceder a la Plataforma", use_container_width=True, type="primary")
-                    if login_button:
-                        try:
-                            user = auth.get_user_by_email(email)
-                            st.session_state.logged_in = True
-                            st.session_state.physician_email = user.email
-                            st.session_state.page = 'control_panel'
-                            st.rerun()
-                        except Exception: st.error("Error: Verifique sus credenciales.")
+                    st.text_input("Correo Electrónico del Médico", key="login_email")
+                    st.text_input("Contraseña", type="password", key="login_password")
+                    st.form_submit_button("Acceder a la Plataforma", use_container_width=True, type="primary", on_click=_do_login)
+                    login_error = st.session_state.pop('login_feedback', None)
+                    if login_error: st.error(login_error)
             with register_tab:
                 with st.form("register_form"):
-                    new_email = st.text_input("Correo para Registro", key="register_email")
-                    new_password = st.text_input("Crear Contraseña", type="password", key="register_password")
-                    confirm_password = st.text_input("Confirmar Contraseña", type="password", key="confirm_password")
-                    register_button = st.form_submit_button("Crear Cuenta", use_container_width=True)
-                    if register_button:
-                        if new_password == confirm_password:
-                            try:
-                                user = auth.create_user(email=new_email, password=new_password)
-                                st.success(f"¡Cuenta para {user.email} creada! Ya puede iniciar sesión.")
-                                st.balloons()
-                            except Exception as e: st.error(f"Error de registro: {e}")
-                        else: st.error("Las contraseñas no coinciden.")
+                    st.text_input("Correo para Registro", key="register_email")
+                    st.text_input("Crear Contraseña", type="password", key="register_password")
+                    st.text_input("Confirmar Contraseña", type="password", key="confirm_password")
+                    st.form_submit_button("Crear Cuenta", use_container_width=True, on_click=_do_register)
+                    feedback = st.session_state.pop('register_feedback', None)
+                    if feedback:
+                        kind, message = feedback
+                        if kind == 'success':
+                            st.success(message)
+                            st.balloons()
+                        else: st.error(message)
 
     # --- MODIFICADO: Logo más grande (250px) y más margen ---
-    st.markdown(
-        f"""
-        <div style="display: flex; justify-content: center; margin-top: 60px; opacity: 0.7;">
-            <img src="{LOGO_URL}" alt="SAVA Logo" style="width: 250px;">
-        </div>
-        """, 
-        unsafe_allow_html=True
-    )
+    st.html(LOGIN_LOGO_HTML.format(logo_src=_logo_src()))
 
 def render_header():
     with st.container(border=True):
         col1, col2, col3 = st.columns([4, 1.5, 1.5])
         with col1:
-            # --- Logo y Email alineados (Sin cambios) ---
-            st.markdown(
-                f"""
-                <div style="display: flex; align-items: center; gap: 15px; height: 100%; min-height: 40px;">
-                    <img src="{LOGO_URL}" alt="SAVA Logo" style="height: 40px;">
-                    <span style="font-weight: 600; font-size: 1.1em; color: var(--text-color);">
-                        👨‍⚕️ {st.session_state.get('physician_email', 'Cargando...')}
-                    </span>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
+            # --- Logo y Email alineados: el HTML se arma una vez por sesión ---
+            if 'header_html' not in st.session_state:
+                st.session_state.header_html = HEADER_BANNER_HTML.format(
+                    logo_src=_logo_src(), physician_email=st.session_state.get('physician_email', 'Cargando...'))
+            st.html(st.session_state.header_html)
         with col2:
-            if st.button("Panel de Control", use_container_width=True):
-                st.session_state.page = 'control_panel'; st.session_state.selected_patient_id = None; st.rerun()
+            st.button("Panel de Control", use_container_width=True, on_click=_navigate, kwargs={'page': 'control_panel', 'selected_patient_id': None})
         with col3:
-            if st.button("Cerrar Sesión", use_container_width=True, type="secondary"):
-                for key in list(st.session_state.keys()): del st.session_state[key]
-                st.rerun()
+            st.button("Cerrar Sesión", use_container_width=True, type="secondary", on_click=_do_logout)
     st.markdown("<br>", unsafe_allow_html=True)
 
 def render_main_app():
@@ -292,7 +313,17 @@ def render_control_panel():
                     st.rerun()
         st.divider()
         st.header("Seleccionar Paciente Existente")
-        patients = firebase_utils.get_physician_patients(st.session_state.physician_email)
+        # Se guarda cuántas páginas pidió el médico, no sus cursores: cada página sigue
+        # al último paciente de la anterior tal como se leyó en este run, así un
+        # paciente nuevo que desplaza los demás no oculta al que queda en el borde.
+        email = st.session_state.physician_email
+        patients, cursor = [], None
+        for _ in range(st.session_state.get('patient_pages', {}).get(email, 1)):
+            page = firebase_utils.get_physician_patients(email, cursor)
+            patients.extend(page)
+            has_more = len(page) == firebase_utils.PATIENTS_PAGE_SIZE
+            if not has_more: break
+            cursor = page[-1]['id']
         if not patients: st.info("No hay pacientes registrados.")
         else:
             for patient in patients:
@@ -302,10 +333,10 @@ def render_control_panel():
                         st.subheader(patient['nombre'])
                         st.caption(f"ID: {patient['cedula']} | Edad: {patient.get('edad', 'N/A')} años")
                     # Este botón ahora será índigo gracias al cambio en CSS
-                    if col2.button("Ver Historial", key=patient['id'], use_container_width=True, type="primary"):
-                        st.session_state.selected_patient_id = patient['id']
-                        st.session_state.page = 'patient_dashboard'
-                        st.rerun()
+                    col2.button("Ver Historial", key=patient['id'], use_container_width=True, type="primary",
+                                on_click=_navigate, kwargs={'selected_patient_id': patient['id'], 'page': 'patient_dashboard'})
+            if has_more:
+                st.button("Cargar más pacientes", use_container_width=True, on_click=_add_page, args=('patient_pages', email))
     
     # [MODIFICADO] Sección "Acerca de" actualizada con título de CEO
     with tab2:
@@ -338,37 +369,95 @@ def render_control_panel():
 
 def render_patient_dashboard():
     patient_id = st.session_state.selected_patient_id
-    patient_info = firebase_utils.get_patient_details(st.session_state.physician_email, patient_id)
+    patient_info, df_history, next_cursor = firebase_utils.load_patient_bundle(st.session_state.physician_email, patient_id)
+    # Páginas anteriores pedidas con "Cargar consultas anteriores". Se guarda cuántas
+    # son y cada una se pide con el cursor que devolvió la anterior en este run, así
+    # una consulta nueva que desplaza el borde de una página no oculta ninguna.
+    extra_pages = st.session_state.get('history_pages', {}).get(patient_id, 1) - 1
+    if extra_pages and next_cursor:
+        pages = [df_history]
+        for _ in range(extra_pages):
+            page, next_cursor = firebase_utils.load_patient_history(st.session_state.physician_email, patient_id, cursor=next_cursor, fields=firebase_utils.HISTORY_VIEW_FIELDS)
+            pages.append(page)
+            if not next_cursor: break
+        df_history = pd.concat(pages, ignore_index=True)
     st.title(f"Dashboard del Paciente: {patient_info.get('nombre', 'N/A')}")
     st.caption(f"Documento: {patient_info.get('cedula', 'N/A')} | Edad: {patient_info.get('edad', 'N/A')} años")
-    df_history = firebase_utils.load_patient_history(st.session_state.physician_email, patient_id)
     if not df_history.empty:
-        pdf_data = create_patient_report_pdf(patient_info, df_history)
-        st.download_button("📄 Descargar Reporte Completo", data=pdf_data, file_name=f"Reporte_{patient_info.get('cedula')}.pdf", mime="application/pdf")
+        # El PDF sólo se construye a petición; luego se reutiliza hasta que cambie el historial.
+        report = st.session_state.get('pdf_report')
+        if report and report[0] == patient_id:
+            st.download_button("📄 Descargar Reporte Completo", data=report[1], file_name=f"Reporte_{patient_info.get('cedula')}.pdf", mime="application/pdf")
+        else:
+            st.button("📄 Preparar Reporte Completo", on_click=_prepare_report, args=(patient_id, patient_info))
     
     tab1, tab2 = st.tabs(["📈 Historial", "✍️ Nueva Consulta"])
     with tab1:
         if df_history.empty: st.info("Este paciente no tiene consultas registradas.")
         else:
-            if st.session_state.ai_analysis_running:
-                consultation_id = st.session_state.last_clicked_ai
-                row = df_history[df_history['id'] == consultation_id].iloc[0]
-                history_summary = "Resumen del historial médico previo relevante."
-                ai_report = GEMINI.generate_ai_holistic_review(patient_info, row.to_dict(), history_summary)
-                firebase_utils.update_consultation_with_ai_analysis(st.session_state.physician_email, patient_id, consultation_id, ai_report)
-                st.session_state.ai_analysis_running = False; st.session_state.last_clicked_ai = None; st.rerun()
-            
-            for _, row in df_history.iterrows():
-                with st.expander(f"Consulta del {row['timestamp'].strftime('%d/%m/%Y %H:%M')}"):
-                    st.write(f"**Motivo:** {row.get('motivo_consulta', 'N/A')}")
-                    if 'ai_analysis' in row and pd.notna(row['ai_analysis']):
-                        st.markdown("---"); st.markdown(row['ai_analysis'])
-                    elif st.button("Generar Análisis con IA", key=f"ai_{row['id']}", disabled=st.session_state.ai_analysis_running or not IS_MODEL_CONFIGURED):
-                        st.session_state.ai_analysis_running = True; st.session_state.last_clicked_ai = row['id']; st.rerun()
+            records = df_history.to_dict('records')
+            for i, row in enumerate(records):
+                # Las consultas cargadas más antiguas que la tarjeta, para el prompt de IA
+                older = records[i + 1:i + 1 + firebase_utils.LAST_CONSULTATIONS_KEPT]
+                _consultation_card(patient_id, patient_info, row, older, next_cursor is None)
+            if next_cursor:
+                st.button("Cargar consultas anteriores", use_container_width=True, on_click=_add_page, args=('history_pages', patient_id))
     with tab2:
-        render_new_consultation_form(patient_id)
+        render_new_consultation_form(patient_id, patient_info, df_history.head(firebase_utils.LAST_CONSULTATIONS_KEPT).to_dict('records'))
 
-def render_new_consultation_form(patient_id):
+def _history_summary(patient_info, loaded, before=None, complete=True):
+    """
+    Resumen del historial previo para el prompt de IA. Combina 'last_consultations'
+    del paciente con las consultas ya cargadas en el historial (los pacientes
+    registrados antes de ese campo no lo tienen) y usa las más recientes anteriores
+    a 'before'. 'complete' indica si no hay consultas más antiguas sin cargar.
+    """
+    fields = firebase_utils.LAST_CONSULTATION_FIELDS
+    merged = {c['id']: c for c in patient_info.get('last_consultations', [])}
+    merged.update((r['id'], {k: r[k] for k in fields if k in r and pd.notna(r[k])}) for r in loaded)
+    prior = [c for c in merged.values() if before is None or c.get('timestamp_utc', '') < before]
+    prior = sorted(prior, key=lambda c: c.get('timestamp_utc', ''), reverse=True)[:firebase_utils.LAST_CONSULTATIONS_KEPT]
+    return build_history_summary(prior, complete)
+
+@st.fragment
+def _consultation_card(patient_id, patient_info, row, older, complete):
+    """
+    Tarjeta de una consulta del historial. Como fragmento, el clic en "Generar
+    Análisis con IA" sólo reejecuta esta tarjeta: el análisis se transmite en el
+    mismo run, se guarda y la tarjeta se vuelve a dibujar con él. 'older' son las
+    consultas cargadas anteriores a esta y 'complete' indica si no quedan más sin cargar.
+    """
+    with st.expander(f"Consulta del {row['timestamp'].strftime('%d/%m/%Y %H:%M')}"):
+        st.write(f"**Motivo:** {row.get('motivo_consulta', 'N/A')}")
+        ai_analysis = row.get('ai_analysis')
+        if pd.notna(ai_analysis):
+            st.markdown("---"); st.markdown(ai_analysis)
+        else:
+            error = st.session_state.get('ai_error')
+            if error and error[0] == row['id']:
+                st.error(st.session_state.pop('ai_error')[1])
+            generating = st.session_state.get('ai_in_flight') == row['id']
+            st.button("Generar Análisis con IA", key=f"ai_{row['id']}", disabled=generating or not IS_MODEL_CONFIGURED,
+                      on_click=_mark_in_flight, args=('ai_in_flight', row['id']))
+            if generating:
+                try:
+                    # Sólo las consultas anteriores a la que se analiza
+                    history_summary = _history_summary(patient_info, older, row['timestamp_utc'], complete)
+                    ai_report = st.write_stream(GEMINI.generate_ai_holistic_review(patient_info, row, history_summary,
+                                                                                   cache_scope=st.session_state.physician_email))
+                except AIReviewError as e:
+                    # No se guarda nada: el error se muestra una vez y el botón queda disponible
+                    st.session_state.ai_error = (row['id'], str(e))
+                else:
+                    firebase_utils.update_consultation_with_ai_analysis(st.session_state.physician_email, patient_id, row['id'], ai_report)
+                    _discard_pdf_report()
+                    # El fragmento se reejecuta con el mismo dict 'row', que ya incluye el análisis
+                    row['ai_analysis'] = ai_report
+                finally:
+                    st.session_state.pop('ai_in_flight', None)
+                st.rerun(scope="fragment")
+
+def render_new_consultation_form(patient_id, patient_info, recent):
     with st.form("new_consultation_form"):
         st.header("Datos de la Consulta")
         with st.expander("1. Anamnesis y Vitales", expanded=True):
@@ -390,13 +479,33 @@ def render_new_consultation_form(patient_id):
             dieta = c1.selectbox("Calidad de la Dieta", ["Saludable (DASH/Mediterránea)", "Regular", "Poco saludable (Procesados)"])
             ejercicio = c2.slider("Ejercicio Aeróbico (min/semana)", 0, 500, 150)
 
-        if st.form_submit_button("Guardar Consulta", use_container_width=True, type="primary"):
-            data = {"motivo_consulta": motivo, "presion_sistolica": sistolica, "presion_diastolica": diastolica, "frec_cardiaca": frec_cardiaca, "glucemia": glucemia, "imc": imc, "sintomas_cardio": sintomas_cardio, "sintomas_resp": sintomas_resp, "sintomas_metabolico": sintomas_metabolico, "dieta": dieta, "ejercicio": ejercicio}
-            firebase_utils.save_consultation(st.session_state.physician_email, patient_id, data)
+        if 'ai_warning' in st.session_state:
+            st.warning("La consulta se guardó sin análisis de IA.")
+            st.markdown(st.session_state.pop('ai_warning'))
+        with_ai = st.checkbox("Generar análisis con IA al guardar", disabled=not IS_MODEL_CONFIGURED)
+        saving = st.session_state.get('consultation_in_flight', False)
+        st.form_submit_button("Guardar Consulta", use_container_width=True, type="primary", disabled=saving,
+                              on_click=_mark_in_flight, args=('consultation_in_flight',))
+        if saving:
+            try:
+                data = {"motivo_consulta": motivo, "presion_sistolica": sistolica, "presion_diastolica": diastolica, "frec_cardiaca": frec_cardiaca, "glucemia": glucemia, "imc": imc, "sintomas_cardio": sintomas_cardio, "sintomas_resp": sintomas_resp, "sintomas_metabolico": sintomas_metabolico, "dieta": dieta, "ejercicio": ejercicio}
+                ai_report = None
+                if with_ai:
+                    history_summary = _history_summary(patient_info, recent)
+                    try:
+                        ai_report = st.write_stream(GEMINI.generate_ai_holistic_review(patient_info, data, history_summary,
+                                                                                       cache_scope=st.session_state.physician_email))
+                    except AIReviewError as e:
+                        # La consulta se guarda sin análisis; se puede generar luego desde el historial
+                        st.session_state.ai_warning = str(e)
+                firebase_utils.save_consultation(st.session_state.physician_email, patient_id, data, ai_report)
+                _discard_pdf_report()
+            finally:
+                st.session_state.pop('consultation_in_flight', None)
             st.rerun()
 
 # ==============================================================================
-# MÓDULO 4: CONTROLADOR PRINCIPAL
+# MÓDULO 3: CONTROLADOR PRINCIPAL
 # ==============================================================================
 def main():
     apply_custom_styling()
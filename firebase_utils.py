@@ -7,16 +7,29 @@ incluyendo la inicialización de la conexión y las operaciones CRUD
 """
 # --- LIBRERÍAS ---
 import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, firestore
+# firebase_admin y pandas se importan dentro de las funciones que los
+# usan, así el arranque de la app no paga su carga hasta el primer acceso.
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+try:
+    from streamlit.runtime.scriptrunner_utils.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+except ImportError:  # streamlit < 1.38
+    from streamlit.runtime.scriptrunner.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from datetime import datetime, timezone
-import pandas as pd
+from itertools import count
+from functools import lru_cache
 
 # --- CONEXIÓN INICIAL ---
 @st.cache_resource
-def init_firebase():
-    """Inicializa y retorna el cliente de la base de datos Firestore."""
+def get_db():
+    """
+    Inicializa y retorna el cliente de la base de datos Firestore.
+    Se crea la primera vez que se usa y se comparte entre sesiones y reruns.
+    """
     try:
+        import firebase_admin
+        from firebase_admin import credentials, firestore
         creds_dict = dict(st.secrets["firebase_credentials"])
         creds_dict['private_key'] = creds_dict['private_key'].replace('\\n', '\n')
         if not firebase_admin._apps:
@@ -28,69 +41,217 @@ def init_firebase():
         st.error(f"Error crítico al conectar con Firebase: {e}", icon="🔥")
         return None
 
-DB = init_firebase()
+# --- CONSTANTES ---
+PATIENT_LIST_FIELDS = ['nombre', 'cedula', 'edad']  # Campos que muestra la lista de pacientes
+PATIENTS_PAGE_SIZE = 500
+HISTORY_PAGE_SIZE = 25
+LAST_CONSULTATIONS_KEPT = 5  # Consultas resumidas en el paciente y en el prompt de IA
+# Campos de cada consulta que se copian a 'last_consultations' del paciente
+LAST_CONSULTATION_FIELDS = ['timestamp_utc', 'motivo_consulta', 'presion_sistolica', 'presion_diastolica', 'glucemia', 'imc']
+REF_CACHE_SIZE = 1024  # Referencias de Firestore reutilizadas por función
+# Pool compartido para solapar lecturas independientes; el SDK de Firestore es bloqueante
+_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='firestore-read')
+# Campos que usan las tarjetas del historial y el prompt de IA (sin frec. cardíaca, dieta ni ejercicio)
+HISTORY_VIEW_FIELDS = [
+    'timestamp_utc', 'motivo_consulta', 'presion_sistolica', 'presion_diastolica', 'glucemia', 'imc',
+    'sintomas_cardio', 'sintomas_resp', 'sintomas_metabolico', 'ai_analysis',
+]
+
+# --- REFERENCIAS DE FIRESTORE ---
+# Ruta: physicians/{email}/patients/{patient_id}/consultations/{consultation_id}
+# Las referencias son inmutables, así que se reutilizan en vez de recorrer la ruta
+# en cada llamada; las consultas derivadas (order_by, select...) crean objetos nuevos.
+@lru_cache(maxsize=REF_CACHE_SIZE)
+def _patients_ref(db, physician_email):
+    return db.collection('physicians').document(physician_email).collection('patients')
+
+@lru_cache(maxsize=REF_CACHE_SIZE)
+def _patient_ref(db, physician_email, patient_id):
+    return _patients_ref(db, physician_email).document(patient_id)
+
+@lru_cache(maxsize=REF_CACHE_SIZE)
+def _consultations_ref(db, physician_email, patient_id):
+    return _patient_ref(db, physician_email, patient_id).collection('consultations')
+
+def _submit(fn, *args, **kwargs):
+    """
+    Envía una lectura al pool con el contexto de Streamlit del script que la pide.
+    Al terminar se restaura el contexto previo del hilo (add_script_run_ctx(ctx=None)
+    no lo quita), para que el hilo no retenga la sesión ni la pase a otra tarea.
+    """
+    ctx = get_script_run_ctx()
+    def run():
+        thread = threading.current_thread()
+        previous = getattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+        add_script_run_ctx(thread, ctx)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, previous)
+    return _POOL.submit(run)
+
+# --- CACHÉ DE LECTURAS ---
+# Las lecturas se cachean con st.cache_data porque cada interacción en Streamlit
+# reejecuta el script. La lista de un médico y el historial de un paciente se leen
+# por páginas con cursores que no se pueden enumerar para .clear(), así que su
+# clave incluye la versión de ese ámbito: una escritura la sube y sólo las
+# lecturas de ese médico o paciente dejan de usarse (vencen con el TTL).
+_cache_versions = {}
+_next_cache_version = count(1).__next__
+
+def _cache_version(*scope):
+    return _cache_versions.get(scope, 0)
+
+def bust_cache(physician_email, patient_id=None, patients=False, details=False, history=False):
+    """
+    Invalida las lecturas cacheadas que afecta una escritura: 'patients' la lista
+    de pacientes del médico, 'details' los datos de 'patient_id' y 'history' su
+    historial de consultas.
+    """
+    if patients:
+        _cache_versions[('patients', physician_email)] = _next_cache_version()
+    if details:
+        _fetch_patient_details.clear(physician_email, patient_id)
+    if history:
+        _cache_versions[('history', physician_email, patient_id)] = _next_cache_version()
 
 # --- FUNCIONES DE PACIENTES ---
-def get_physician_patients(physician_email):
-    """Obtiene una lista de todos los pacientes asociados a un médico."""
-    if not DB: return []
-    patients_ref = DB.collection('physicians').document(physician_email).collection('patients').stream()
+def get_physician_patients(physician_email, start_after=None, page_size=PATIENTS_PAGE_SIZE):
+    """
+    Obtiene una página de los pacientes asociados a un médico, ordenados por ID.
+    Sólo se descargan los campos de PATIENT_LIST_FIELDS; 'start_after' es el ID
+    del último paciente de la página anterior.
+    """
+    return _fetch_physician_patients(physician_email, start_after, page_size, _cache_version('patients', physician_email))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_physician_patients(physician_email, start_after, page_size, version):
+    """Lectura cacheada de get_physician_patients; 'version' sólo forma parte de la clave."""
+    db = get_db()
+    if not db: return []
+    query = _patients_ref(db, physician_email).order_by('__name__').select(PATIENT_LIST_FIELDS)
+    if start_after: query = query.start_after({'__name__': start_after})
+    patients_ref = query.limit(page_size).stream()
     return [{'id': doc.id, **doc.to_dict()} for doc in patients_ref]
 
 def get_patient_details(physician_email, patient_id):
     """
     [FUNCIÓN CORREGIDA] Obtiene los detalles de un paciente específico.
-    Soluciona el error AttributeError.
+    Soluciona el error AttributeError. Un error de lectura no se cachea: el
+    siguiente rerun vuelve a consultar Firestore.
     """
-    if not DB: return {}
+    if not get_db(): return {}
     try:
-        patient_ref = DB.collection('physicians').document(physician_email).collection('patients').document(patient_id)
-        patient_doc = patient_ref.get()
-        if patient_doc.exists:
-            return patient_doc.to_dict()
-        else:
-            st.warning("No se encontró el documento del paciente.")
-            return {}
+        patient = _fetch_patient_details(physician_email, patient_id)
     except Exception as e:
         st.error(f"No se pudieron cargar los datos del paciente: {e}")
         return {}
+    if patient is None:
+        st.warning("No se encontró el documento del paciente.")
+        return {}
+    return patient
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_patient_details(physician_email, patient_id):
+    """Lectura cacheada del documento del paciente (None si no existe); las excepciones no se cachean."""
+    patient_doc = _patient_ref(get_db(), physician_email, patient_id).get()
+    return patient_doc.to_dict() if patient_doc.exists else None
 
 def save_new_patient(physician_email, patient_data):
     """Guarda un nuevo paciente en la base de datos."""
-    if not DB: return
-    DB.collection('physicians').document(physician_email).collection('patients').document(patient_data['cedula']).set(patient_data)
+    db = get_db()
+    if not db: return
+    _patient_ref(db, physician_email, patient_data['cedula']).set(patient_data)
+    bust_cache(physician_email, patient_data['cedula'], patients=True, details=True)
     st.success(f"Paciente {patient_data['nombre']} registrado exitosamente.")
 
 # --- FUNCIONES DE CONSULTAS ---
-def save_consultation(physician_email, patient_id, consultation_data):
-    """Guarda una nueva consulta para un paciente."""
-    if not DB: return None
-    timestamp = datetime.now(timezone.utc)
-    doc_id = timestamp.strftime('%Y-%m-%d_%H-%M-%S')
-    consultation_data['timestamp_utc'] = timestamp.isoformat()
-    clean_data = {k: v for k, v in consultation_data.items() if v is not None and v != ''}
-    DB.collection('physicians').document(physician_email).collection('patients').document(patient_id).collection('consultations').document(doc_id).set(clean_data)
+def save_consultation(physician_email, patient_id, consultation_data, ai_report=None):
+    """
+    Guarda una nueva consulta para un paciente. Si ya se tiene el análisis de IA,
+    se escribe en el mismo documento y la misma escritura, sin un update aparte.
+    El resumen de la consulta se agrega a 'last_consultations' del paciente en la
+    misma transacción, que conserva sólo las LAST_CONSULTATIONS_KEPT más recientes.
+    """
+    from firebase_admin import firestore
+    db = get_db()
+    if not db: return None
+    # Marca del cliente (no SERVER_TIMESTAMP): el historial ordena y pagina por
+    # timestamp_utc y las consultas existentes lo guardan como texto ISO 8601.
+    consultation_data['timestamp_utc'] = datetime.now(timezone.utc).isoformat()
+    if ai_report: consultation_data['ai_analysis'] = ai_report
+    consultation_data = _clean_consultation(consultation_data)
+    # ID automático: dos consultas guardadas en el mismo segundo no se pisan
+    consultation_ref = _consultations_ref(db, physician_email, patient_id).document()
+    doc_id = consultation_ref.id
+    patient_ref = _patient_ref(db, physician_email, patient_id)
+    summary = {'id': doc_id, **{k: consultation_data[k] for k in LAST_CONSULTATION_FIELDS if k in consultation_data}}
+
+    @firestore.transactional
+    def write(transaction):
+        # En una transacción las lecturas deben ir antes que las escrituras
+        current = (patient_ref.get(transaction=transaction).to_dict() or {}).get('last_consultations', [])
+        latest = sorted([summary, *current], key=lambda c: c.get('timestamp_utc', ''), reverse=True)
+        transaction.set(consultation_ref, consultation_data)
+        transaction.set(patient_ref, {'last_consultations': latest[:LAST_CONSULTATIONS_KEPT]}, merge=True)
+    write(db.transaction())
+    bust_cache(physician_email, patient_id, details=True, history=True)
     st.toast("Consulta guardada.", icon="✅")
     return doc_id
 
+def _clean_consultation(consultation_data):
+    """Descarta los campos vacíos antes de escribir una consulta."""
+    return {k: v for k, v in consultation_data.items() if v is not None and v != ''}
+
 def update_consultation_with_ai_analysis(physician_email, patient_id, consultation_id, ai_report):
     """Actualiza una consulta existente con el análisis de la IA."""
-    if not DB: return
-    consultation_ref = DB.collection('physicians').document(physician_email).collection('patients').document(patient_id).collection('consultations').document(consultation_id)
+    db = get_db()
+    if not db: return
+    consultation_ref = _consultations_ref(db, physician_email, patient_id).document(consultation_id)
     consultation_ref.update({"ai_analysis": ai_report})
+    bust_cache(physician_email, patient_id, history=True)
     st.toast("Análisis de IA guardado en el historial.", icon="🧠")
 
-def load_patient_history(physician_email, patient_id):
-    """Carga el historial completo de consultas de un paciente."""
-    if not DB: return pd.DataFrame()
-    consultations_ref = DB.collection('physicians').document(physician_email).collection('patients').document(patient_id).collection('consultations').order_by('timestamp_utc', direction=firestore.Query.DESCENDING).stream()
-    records = []
-    for doc in consultations_ref:
-        record = doc.to_dict()
-        record['id'] = doc.id
-        records.append(record)
-    if not records: return pd.DataFrame()
-    df = pd.DataFrame(records)
-    df['timestamp'] = pd.to_datetime(df['timestamp_utc'], errors='coerce')
-    return df
+def load_patient_history(physician_email, patient_id, page_size=HISTORY_PAGE_SIZE, cursor=None, fields=None):
+    """
+    Carga una página del historial de consultas de un paciente, de la más reciente
+    a la más antigua. 'cursor' es el par (timestamp_utc, id) de la última consulta
+    de la página anterior, 'fields' limita los campos descargados y page_size=None
+    carga el historial completo. Retorna (df, cursor de la página siguiente o None).
+    """
+    version = _cache_version('history', physician_email, patient_id)
+    return _fetch_patient_history(physician_email, patient_id, page_size, cursor, fields, version)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_patient_history(physician_email, patient_id, page_size, cursor, fields, version):
+    """Lectura cacheada de load_patient_history; 'version' sólo forma parte de la clave."""
+    import pandas as pd
+    db = get_db()
+    if not db: return pd.DataFrame(), None
+    # Orden ascendente + limit_to_last: el índice entrega sólo la cola más reciente.
+    # El ID desempata consultas con la misma marca, así ninguna se pierde entre páginas.
+    query = _consultations_ref(db, physician_email, patient_id).order_by('timestamp_utc').order_by('__name__')
+    if fields: query = query.select(sorted({*fields, 'timestamp_utc'}))
+    if cursor: query = query.end_before({'timestamp_utc': cursor[0], '__name__': cursor[1]})
+    if page_size: query = query.limit_to_last(page_size)
+    # limit_to_last no admite stream(); get() ya entrega la página en orden ascendente
+    records = [{**doc.to_dict(), 'id': doc.id} for doc in reversed(query.get())]
+    if not records: return pd.DataFrame(), None
+    next_cursor = (records[-1]['timestamp_utc'], records[-1]['id']) if page_size and len(records) == page_size else None
+    # from_records une las claves de todos los registros (las consultas omiten los
+    # campos vacíos) y conserva las listas de síntomas como listas de Python.
+    df = pd.DataFrame.from_records(records)
+    # Las marcas se guardan con isoformat(); indicar el formato evita la inferencia por fila
+    df['timestamp'] = pd.to_datetime(df['timestamp_utc'], format='ISO8601', utc=True, cache=True, errors='coerce')
+    return df, next_cursor
 
+def load_patient_bundle(physician_email, patient_id):
+    """
+    Carga los detalles y la primera página del historial de un paciente con las
+    dos lecturas en paralelo: el historial se consulta en un hilo aparte mientras
+    este hilo lee el documento del paciente, así la espera es la de la lectura más
+    lenta. Retorna (patient_info, df, cursor de la página siguiente o None).
+    """
+    history_future = _submit(load_patient_history, physician_email, patient_id, fields=HISTORY_VIEW_FIELDS)
+    patient_info = get_patient_details(physician_email, patient_id)
+    return (patient_info, *history_future.result())
@@ -9,11 +9,147 @@ análisis clínicos a partir de los datos del paciente.
 import streamlit as st
 import google.generativeai as genai
 import logging
+import threading
+import time
+from functools import lru_cache
+from collections import ChainMap
 
 # Configuración del logging para monitorear la selección de modelos
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --- CONFIGURACIÓN DEL PROMPT ---
+REVIEW_CACHE_TTL = 300  # Segundos que se reutiliza un análisis ya generado para el mismo prompt
+GENERATION_CONFIG = {
+    "temperature": 0.3,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 4096,
+}
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
+]
+
+# Plantilla del reporte clínico, definida una sola vez y sin sangría para no
+# enviar (ni facturar) espacios de más a Gemini en cada llamada.
+_PROMPT_TEMPLATE = """\
+**ROL Y OBJETIVO:** Eres un médico especialista en medicina interna y cardiología. Tu objetivo es actuar como un co-piloto para otro médico, analizando los datos de un paciente para generar un reporte clínico estructurado, profesional y accionable.
+
+**CONTEXTO DEL PACIENTE:**
+- Nombre: {nombre}
+- Edad: {edad} años
+
+**DATOS DE LA CONSULTA ACTUAL:**
+- Motivo: {motivo_consulta}
+- Signos Vitales: PA {presion_sistolica}/{presion_diastolica} mmHg, Glucemia {glucemia} mg/dL, IMC {imc} kg/m².
+- Síntomas Relevantes: Cardiovascular({sintomas_cardio}), Respiratorio({sintomas_resp}), Metabólico({sintomas_metabolico})
+
+**RESUMEN DEL HISTORIAL PREVIO:**
+{history_summary}
+
+**TAREA: Genera el reporte usando estrictamente el siguiente formato Markdown:**
+
+### Análisis Clínico Integral por IA
+**1. RESUMEN DEL CASO:**
+(Presenta un resumen conciso del paciente, su edad, y el motivo de la consulta actual en el contexto de su historial.)
+**2. IMPRESIÓN DIAGNÓSTICA Y DIFERENCIALES:**
+(Basado en la constelación de signos, síntomas y factores de riesgo, ¿cuál es el diagnóstico más probable? Menciona 2 o 3 diagnósticos diferenciales.)
+**3. ESTRATIFICACIÓN DEL RIESGO:**
+(Evalúa el riesgo cardiovascular y/o metabólico global del paciente. Clasifícalo como BAJO, MODERADO, ALTO o MUY ALTO y justifica.)
+**4. PLAN DE MANEJO SUGERIDO:**
+- **Estudios Diagnósticos:** (Lista de exámenes necesarios.)
+- **Tratamiento No Farmacológico:** (Recomendaciones clave sobre estilo de vida.)
+- **Tratamiento Farmacológico:** (Sugiere clases de medicamentos.)
+- **Metas Terapéuticas:** (Establece objetivos numéricos claros.)
+**5. PUNTOS CLAVE PARA EDUCACIÓN DEL PACIENTE:**
+(Proporciona 3-4 puntos en lenguaje sencillo.)"""
+_PROMPT_DEFAULTS = {
+    'nombre': 'No especificado',
+    'edad': 'No especificada',
+    'motivo_consulta': 'No especificado',
+    'sintomas_cardio': [],
+    'sintomas_resp': [],
+    'sintomas_metabolico': [],
+}
+
+class _PromptContext(ChainMap):
+    """Contexto del prompt: los campos sin valor ni default se muestran como 'N/A'."""
+    def __missing__(self, key):
+        return 'N/A'
+
+_HISTORY_LINE = "- {fecha}: {motivo_consulta}. PA {presion_sistolica}/{presion_diastolica} mmHg, Glucemia {glucemia} mg/dL, IMC {imc} kg/m²."
+
+def build_history_summary(consultations, complete=True):
+    """
+    Arma el resumen del historial previo para el prompt a partir de las consultas
+    previas (de la más reciente a la más antigua). 'complete' indica si la lista
+    cubre todo el historial anterior: sólo entonces una lista vacía se informa al
+    modelo como ausencia de consultas previas.
+    """
+    if not consultations:
+        return "Sin consultas previas registradas." if complete else "Consultas previas no disponibles para este resumen."
+    return '\n'.join(_HISTORY_LINE.format_map(_PromptContext({'fecha': c.get('timestamp_utc', '')[:10]}, c))
+                     for c in consultations)
+
+# --- SELECCIÓN DEL MODELO ---
+# Lista de modelos actualizada para 2025, de más nuevo a más estable
+MODEL_PREFERENCE = (
+    "gemini-2.0-flash-exp",
+    "gemini-1.5-flash-latest",
+    "gemini-1.5-pro-latest",
+    "gemini-1.5-flash",
+    "gemini-1.5-pro",
+)
+MODEL_PROBE_RETRY_SECONDS = 60  # Tras un sondeo fallido, segundos antes de volver a consultar la API
+_model_probe_failures = {}  # lista de modelos -> (reintentar desde, mensaje de error)
+
+def _pick_model_name(model_list):
+    """
+    Retorna el modelo elegido para la lista. Un sondeo fallido se recuerda durante
+    MODEL_PROBE_RETRY_SECONDS: mientras tanto se relanza el mismo error sin llamar
+    a la API, así una key inválida o una caída de red no cuestan una RPC por rerun.
+    """
+    failure = _model_probe_failures.get(model_list)
+    if failure and failure[0] > time.monotonic():
+        raise Exception(failure[1])
+    try:
+        return _probe_model_name(model_list)
+    except Exception as e:
+        _model_probe_failures[model_list] = (time.monotonic() + MODEL_PROBE_RETRY_SECONDS, str(e))
+        raise
+
+@lru_cache(maxsize=None)
+def _probe_model_name(model_list):
+    """
+    Retorna el nombre del primer modelo de la lista, en orden de preferencia, que
+    la API ofrece para generateContent. Construir un GenerativeModel no valida el
+    nombre, así que se consulta list_models() una sola vez. El éxito se memoriza por
+    lista; los fallos los recuerda _pick_model_name por un tiempo limitado.
+    """
+    try:
+        available = {m.name.split('/')[-1] for m in genai.list_models()
+                     if 'generateContent' in m.supported_generation_methods}
+    except Exception as e:
+        logger.error(f"Error crítico: No se pudo obtener la lista de modelos de Gemini. Error: {e}")
+        raise Exception("No se pudo conectar con ningún modelo de IA. Verifique la API Key y la disponibilidad del servicio.")
+
+    for model_name in model_list:
+        if model_name in available:
+            logger.info(f"Éxito: Modelo '{model_name}' disponible.")
+            # st.toast(f"Modelo IA conectado: {model_name}", icon="🤖")
+            return model_name
+        logger.warning(f"Fallo: Modelo '{model_name}' no disponible.")
+
+    logger.error("Error crítico: Ninguno de los modelos de Gemini preferidos está disponible.")
+    raise Exception("No se pudo conectar con ningún modelo de IA. Verifique la API Key y la disponibilidad del servicio.")
+
+class AIReviewError(Exception):
+    """El análisis no se pudo generar; el mensaje (en markdown) es para mostrarlo, no para guardarlo."""
+
+
 class GeminiUtils:
     def __init__(self):
         """
@@ -25,100 +161,59 @@ class GeminiUtils:
         
         genai.configure(api_key=self.api_key)
         self.model = self._get_available_model()
+        # (ámbito, prompt) -> (expiración, texto). La instancia se comparte vía
+        # get_gemini() entre sesiones e hilos, así que la caché se usa con el lock.
+        self._review_cache = {}
+        self._review_lock = threading.Lock()
 
     def _get_available_model(self):
         """
-        Intenta inicializar modelos de una lista predefinida en orden de preferencia.
-        Retorna la primera instancia de modelo que funcione.
+        Retorna una instancia del primer modelo funcional de MODEL_PREFERENCE.
+        La selección se memoriza, así que sólo la primera instancia sondea modelos.
         """
-        # Lista de modelos actualizada para 2025, de más nuevo a más estable
-        model_list = [
-            "gemini-2.0-flash-exp",
-            "gemini-1.5-flash-latest",
-            "gemini-1.5-pro-latest",
-            "gemini-1.5-flash",
-            "gemini-1.5-pro",
-        ]
-        
-        for model_name in model_list:
-            try:
-                model = genai.GenerativeModel(model_name)
-                logger.info(f"Éxito: Modelo '{model_name}' inicializado correctamente.")
-                # st.toast(f"Modelo IA conectado: {model_name}", icon="🤖")
-                return model
-            except Exception as e:
-                logger.warning(f"Fallo: Modelo '{model_name}' no disponible. Error: {e}")
-                continue
-        
-        logger.error("Error crítico: No se pudo inicializar ningún modelo de Gemini.")
-        raise Exception("No se pudo conectar con ningún modelo de IA. Verifique la API Key y la disponibilidad del servicio.")
+        return genai.GenerativeModel(_pick_model_name(MODEL_PREFERENCE))
 
-    @st.cache_data(show_spinner="Generando análisis y recomendaciones con IA...", ttl=300)
-    def generate_ai_holistic_review(_self, patient_info, latest_consultation, history_summary):
+    def generate_ai_holistic_review(self, patient_info, latest_consultation, history_summary, cache_scope=None):
         """
         Genera un análisis clínico integral utilizando el modelo de IA seleccionado.
-        El guion bajo en _self es una convención para que st.cache_data ignore el
-        parámetro 'self' del objeto y cachee la función correctamente.
-        """
-        if not _self.model:
-            return "Error: El modelo de IA no está inicializado. No se puede generar el análisis."
-
-        generation_config = {
-            "temperature": 0.3,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 4096,
-        }
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
-        ]
-
-        prompt = f"""
-        **ROL Y OBJETIVO:** Eres un médico especialista en medicina interna y cardiología. Tu objetivo es actuar como un co-piloto para otro médico, analizando los datos de un paciente para generar un reporte clínico estructurado, profesional y accionable.
-
-        **CONTEXTO DEL PACIENTE:**
-        - Nombre: {str(patient_info.get('nombre', 'No especificado'))}
-        - Edad: {str(patient_info.get('edad', 'No especificada'))} años
-        
-        **DATOS DE LA CONSULTA ACTUAL:**
-        - Motivo: {str(latest_consultation.get('motivo_consulta', 'No especificado'))}
-        - Signos Vitales: PA {str(latest_consultation.get('presion_sistolica', 'N/A'))}/{str(latest_consultation.get('presion_diastolica', 'N/A'))} mmHg, Glucemia {str(latest_consultation.get('glucemia', 'N/A'))} mg/dL, IMC {str(latest_consultation.get('imc', 'N/A'))} kg/m².
-        - Síntomas Relevantes: Cardiovascular({str(latest_consultation.get('sintomas_cardio', []))}), Respiratorio({str(latest_consultation.get('sintomas_resp', []))}), Metabólico({str(latest_consultation.get('sintomas_metabolico', []))})
-
-        **RESUMEN DEL HISTORIAL PREVIO:**
-        {history_summary}
-
-        **TAREA: Genera el reporte usando estrictamente el siguiente formato Markdown:**
-
-        ### Análisis Clínico Integral por IA
-        **1. RESUMEN DEL CASO:**
-        (Presenta un resumen conciso del paciente, su edad, y el motivo de la consulta actual en el contexto de su historial.)
-        **2. IMPRESIÓN DIAGNÓSTICA Y DIFERENCIALES:**
-        (Basado en la constelación de signos, síntomas y factores de riesgo, ¿cuál es el diagnóstico más probable? Menciona 2 o 3 diagnósticos diferenciales.)
-        **3. ESTRATIFICACIÓN DEL RIESGO:**
-        (Evalúa el riesgo cardiovascular y/o metabólico global del paciente. Clasifícalo como BAJO, MODERADO, ALTO o MUY ALTO y justifica.)
-        **4. PLAN DE MANEJO SUGERIDO:**
-        - **Estudios Diagnósticos:** (Lista de exámenes necesarios.)
-        - **Tratamiento No Farmacológico:** (Recomendaciones clave sobre estilo de vida.)
-        - **Tratamiento Farmacológico:** (Sugiere clases de medicamentos.)
-        - **Metas Terapéuticas:** (Establece objetivos numéricos claros.)
-        **5. PUNTOS CLAVE PARA EDUCACIÓN DEL PACIENTE:**
-        (Proporciona 3-4 puntos en lenguaje sencillo.)
+        Es un generador: entrega el texto por fragmentos a medida que el modelo lo
+        produce, para mostrarlo con st.write_stream sin esperar la respuesta completa.
+        'cache_scope' (p. ej. el email del médico) limita a quién se reutiliza un
+        análisis ya generado: sólo a llamadas con el mismo ámbito.
+        Si el modelo falla lanza AIReviewError, así el texto del error nunca llega
+        a guardarse como si fuera un análisis.
         """
-        
+        if not self.model:
+            raise AIReviewError("Error: El modelo de IA no está inicializado. No se puede generar el análisis.")
+
+        # Los placeholders son los nombres de campo de Firestore: format_map los lee
+        # directamente de los diccionarios, sin copiarlos ni hacer un .get por campo.
+        prompt = _PROMPT_TEMPLATE.format_map(_PromptContext(
+            {'history_summary': history_summary}, latest_consultation, patient_info, _PROMPT_DEFAULTS))
+
+        # El prompt contiene exactamente los campos que usa el modelo, así que es la
+        # clave de caché natural (Timestamps o NaN de otras columnas no la alteran).
+        key = (cache_scope, prompt)
+        with self._review_lock:
+            cached = self._review_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            yield cached[1]
+            return
+
+        chunks = []
         try:
-            response = _self.model.generate_content(
+            response = self.model.generate_content(
                 prompt,
-                generation_config=generation_config,
-                safety_settings=safety_settings
+                generation_config=GENERATION_CONFIG,
+                safety_settings=SAFETY_SETTINGS,
+                stream=True
             )
-            return response.text
+            for chunk in response:
+                chunks.append(chunk.text)
+                yield chunks[-1]
         except Exception as e:
             logger.error(f"Error al generar contenido con la IA: {e}")
-            return f"""
+            raise AIReviewError(f"""
             **Error al contactar al asistente de IA.**
             **Detalle:** {str(e)}
             
@@ -128,4 +223,17 @@ class GeminiUtils:
             3.  **Sobrecarga del Servicio:** El servicio de IA puede estar experimentando alta demanda.
             
             Por favor, inténtelo de nuevo más tarde o modifique la consulta.
-            """
+            """) from e
+        self._store_review(key, ''.join(chunks))
+
+    def _store_review(self, key, text):
+        """Guarda un análisis completo en la caché y descarta las entradas vencidas."""
+        now = time.monotonic()
+        with self._review_lock:
+            self._review_cache = {k: v for k, v in self._review_cache.items() if v[0] > now}
+            self._review_cache[key] = (now + REVIEW_CACHE_TTL, text)
+
+@st.cache_resource
+def get_gemini():
+    """Crea el cliente de Gemini una sola vez y lo comparte entre sesiones y reruns."""
+    return GeminiUtils()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Utilidades de Reportes PDF
+Descripción: Genera el reporte clínico en PDF de un paciente con ReportLab,
+convirtiendo el Markdown de los análisis de IA al marcado de párrafos.
+Vive fuera de app.py para que Streamlit no lo reejecute en cada rerun: las
+expresiones compiladas y la hoja de estilos se crean una vez por proceso.
+"""
+# --- LIBRERÍAS ---
+import pandas as pd
+from tempfile import SpooledTemporaryFile
+from functools import lru_cache
+import math
+import re
+# ReportLab se importa dentro de las funciones que lo usan para no cargarlo en el arranque.
+
+# --- CONSTANTES ---
+PDF_SPOOL_MAX_BYTES = 1 << 20  # Reportes de más de 1 MB se vuelcan a disco al construirse
+# Expresión precompilada para convertir el Markdown de la IA al marcado de ReportLab
+# (grupo 1: **negrita**, grupo 2: ### encabezado) en una sola pasada.
+_MD_RE = re.compile(r'\*\*(.*?)\*\*|###\s?(.*)')
+
+# --- CONVERSIÓN DE TEXTO ---
+def _md_to_markup(match):
+    if match.group(1) is not None:
+        return f"<b>{match.group(1)}</b>"
+    # El encabezado puede contener negritas; se procesan sólo en esa línea.
+    return f"<b>{_MD_RE.sub(_md_to_markup, match.group(2))}</b>"
+
+def clean_html_for_reportlab(text):
+    if '**' not in text and '###' not in text:
+        return text.replace('\n', '<br/>')
+    return _MD_RE.sub(_md_to_markup, text).replace('\n', '<br/>')
+
+def _pdf_text(value):
+    """Texto de una celda del historial; 'N/A' si falta o es NaN."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'N/A'
+    return str(value)
+
+# --- CONSTRUCCIÓN DEL REPORTE ---
+@lru_cache(maxsize=1)
+def _pdf_styles():
+    """Hoja de estilos de ReportLab compartida por todos los reportes (no se modifica)."""
+    from reportlab.lib.styles import getSampleStyleSheet
+    return getSampleStyleSheet()
+
+def create_patient_report_pdf(patient_info, history_df):
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    from reportlab.lib.units import inch
+
+    styles = _pdf_styles()
+    h1, h2, normal = styles['h1'], styles['h2'], styles['Normal']
+    section_gap = Spacer(1, 0.25 * inch)
+    story = [
+        Paragraph(f"Reporte Clínico de {str(patient_info.get('nombre', 'N/A'))}", h1),
+        Paragraph(f"Documento: {patient_info.get('cedula', 'N/A')}", normal),
+        Paragraph(f"Edad: {patient_info.get('edad', 'N/A')} años", normal),
+        section_gap,
+    ]
+
+    # itertuples evita construir una Series por fila como hace iterrows
+    rows = history_df.sort_values('timestamp', kind='mergesort').itertuples(index=False)
+    for row in rows:
+        motivo = _pdf_text(getattr(row, 'motivo_consulta', None)).replace('\n', '<br/>')
+        pa_s = _pdf_text(getattr(row, 'presion_sistolica', None))
+        pa_d = _pdf_text(getattr(row, 'presion_diastolica', None))
+        story.extend((
+            Paragraph(f"Consulta del {row.timestamp.strftime('%d de %B, %Y')}", h2),
+            Paragraph(f"<b>Motivo:</b> {motivo}", normal),
+            Paragraph(f"<b>Signos Vitales:</b> PA: {pa_s}/{pa_d} mmHg", normal),
+        ))
+
+        ai_analysis = getattr(row, 'ai_analysis', None)
+        if pd.notna(ai_analysis):
+            analysis_text = clean_html_for_reportlab(str(ai_analysis))
+            try:
+                analysis = Paragraph(analysis_text, normal)
+            except Exception as e:
+                analysis = Paragraph(f"Error al renderizar análisis: {e}", normal)
+            story.extend((
+                Spacer(1, 0.1 * inch),
+                Paragraph("<b>--- Análisis por IA (SaludIA) ---</b>", normal),
+                analysis,
+            ))
+        story.append(section_gap)
+    with SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES) as buffer:
+        doc = SimpleDocTemplate(buffer, pagesize=(8.5 * inch, 11 * inch))
+        doc.build(story)
+        buffer.seek(0)
+        return buffer.read()
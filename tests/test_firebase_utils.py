@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de firebase_utils que no requieren conexión con Firestore."""
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+pytest.importorskip("streamlit")
+import firebase_utils
+from firebase_utils import SCRIPT_RUN_CONTEXT_ATTR_NAME
+
+
+def _thread_ctx():
+    thread = threading.current_thread()
+    return thread, getattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+
+
+def test_submit_detaches_script_ctx_after_task():
+    """El hilo del pool ve el contexto del script sólo mientras corre la tarea."""
+    ctx = MagicMock(name='ScriptRunContext')
+    main = threading.current_thread()
+    setattr(main, SCRIPT_RUN_CONTEXT_ATTR_NAME, ctx)
+    try:
+        worker, seen = firebase_utils._submit(_thread_ctx).result()
+    finally:
+        setattr(main, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+
+    assert worker is not main
+    assert seen is ctx
+    assert getattr(worker, SCRIPT_RUN_CONTEXT_ATTR_NAME, None) is None
+
+
+def _snapshot(doc_id, data):
+    snap = MagicMock(id=doc_id)
+    snap.to_dict.return_value = dict(data)
+    return snap
+
+
+def _fake_db(snapshots):
+    """Cliente falso: cualquier cadena de consultas termina en get() -> snapshots."""
+    query = MagicMock(name='Query')
+    for method in ('order_by', 'select', 'start_after', 'end_before', 'limit', 'limit_to_last'):
+        getattr(query, method).return_value = query
+    query.get.return_value = snapshots
+    db = MagicMock(name='Client')
+    db.collection.return_value.document.return_value.collection.return_value \
+        .document.return_value.collection.return_value = query
+    return db
+
+
+def test_load_patient_history_keeps_fields_missing_from_newest_record(monkeypatch):
+    """Un campo ausente en la consulta más reciente no se pierde en las anteriores."""
+    pytest.importorskip("pandas")
+    older = {'timestamp_utc': '2024-05-01T10:00:00+00:00', 'motivo_consulta': 'Control',
+             'ai_analysis': 'Análisis previo', 'sintomas_cardio': ['Dolor de pecho', 'Disnea']}
+    newest = {'timestamp_utc': '2024-06-01T10:00:00.250000+00:00'}
+    # get() entrega la página en orden ascendente: la más reciente va al final
+    monkeypatch.setattr(firebase_utils, 'get_db', lambda: _fake_db([_snapshot('a', older), _snapshot('b', newest)]))
+    firebase_utils._fetch_patient_history.clear()
+
+    df, next_cursor = firebase_utils.load_patient_history('medico@example.com', 'p1', page_size=10)
+    records = df.to_dict('records')
+
+    assert [r['id'] for r in records] == ['b', 'a']
+    assert records[1]['ai_analysis'] == 'Análisis previo'
+    assert records[1]['motivo_consulta'] == 'Control'
+    assert records[1]['sintomas_cardio'] == ['Dolor de pecho', 'Disnea']
+    assert df['timestamp'].notna().all()
+    assert next_cursor is None
+
+
+def test_get_patient_details_does_not_cache_read_errors(monkeypatch):
+    """Un error transitorio de Firestore no deja al paciente vacío en la caché."""
+    db = MagicMock(name='Client')
+    snapshot = MagicMock(exists=True)
+    snapshot.to_dict.return_value = {'nombre': 'Ana'}
+    patient_ref = db.collection.return_value.document.return_value.collection.return_value.document.return_value
+    patient_ref.get.side_effect = [RuntimeError('unavailable'), snapshot]
+    monkeypatch.setattr(firebase_utils, 'get_db', lambda: db)
+    firebase_utils._fetch_patient_details.clear()
+
+    assert firebase_utils.get_patient_details('medico@example.com', 'p1') == {}
+    assert firebase_utils.get_patient_details('medico@example.com', 'p1') == {'nombre': 'Ana'}
+
+
+def test_bust_cache_only_invalidates_the_written_scope():
+    """Una escritura invalida las lecturas de su médico y paciente, no las de otros."""
+    other_patients = firebase_utils._cache_version('patients', 'otro@example.com')
+    other_history = firebase_utils._cache_version('history', 'medico@example.com', 'p2')
+    history = firebase_utils._cache_version('history', 'medico@example.com', 'p1')
+
+    firebase_utils.bust_cache('medico@example.com', 'p1', history=True)
+
+    assert firebase_utils._cache_version('history', 'medico@example.com', 'p1') != history
+    assert firebase_utils._cache_version('history', 'medico@example.com', 'p2') == other_history
+    assert firebase_utils._cache_version('patients', 'otro@example.com') == other_patients